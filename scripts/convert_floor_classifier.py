@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+'''
+Converts pickled floor classifier settings (.clf) to the numpy archive
+format (.npz) preferred by the floor detector, which loads without
+unpickling sklearn objects
+
+Usage: convert_floor_classifier.py classifiers/floor_classifier_params_*.clf
+'''
+
+import os
+import pickle
+import sys
+
+from iarc7_vision.floor_detector import save_classifier
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: {} CLASSIFIER.clf [CLASSIFIER.clf ...]'.format(sys.argv[0]))
+        sys.exit(1)
+
+    for filename in sys.argv[1:]:
+        settings = pickle.load(open(filename, 'rb'))
+        saved_filepath = os.path.splitext(filename)[0] + '.npz'
+        save_classifier(settings, saved_filepath)
+        print('Saved {} to {}'.format(filename, saved_filepath))
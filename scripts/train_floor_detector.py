@@ -18,10 +18,14 @@ from sensor_msgs.msg import Image
 
 from iarc7_vision.filterbank import get_RFS_filters_in_tensorflow_format
 from iarc7_vision.image_filter_applicator import ImageFilterApplicator
-from iarc7_vision.floor_detector import SettingsObject
+from iarc7_vision.floor_detector import SettingsObject, save_classifier
 
 bridge = CvBridge()
 
+# Fraction of the smallest filter response spread seen in a boundary frame
+# used as the threshold below which the detector skips the classifier
+MIN_FEATURE_STD_MARGIN = 0.5
+
 
 def stretch_contrast(img):
     maximum = np.max(img)
@@ -113,6 +117,38 @@ def create_classifier_set(floor_vectors, not_floor_vectors):
     return all_vectors, all_labels
 
 
+def find_min_feature_std(floor_images, not_floor_images, min_patches):
+    """
+    Find the smallest spread of the filter responses in frames with a
+    boundary. Boundary frames are made by splicing the edge rows or columns
+    of one class onto whole frames of the other, with just enough patches
+    that the detector could accept the boundary.
+    """
+    num_frames = min(floor_images.shape[0], not_floor_images.shape[0])
+    floor_images = floor_images[:num_frames]
+    not_floor_images = not_floor_images[:num_frames]
+
+    height, width = floor_images.shape[1:3]
+    rows = int(np.ceil(float(min_patches) / width))
+    cols = int(np.ceil(float(min_patches) / height))
+    edges = [(slice(None, rows), slice(None)),
+             (slice(-rows, None), slice(None)),
+             (slice(None), slice(None, cols)),
+             (slice(None), slice(-cols, None))]
+
+    min_std = np.inf
+    for base, edge_source in ((floor_images, not_floor_images),
+                              (not_floor_images, floor_images)):
+        for edge_rows, edge_cols in edges:
+            frames = base.copy()
+            frames[:, edge_rows, edge_cols] = \
+                edge_source[:, edge_rows, edge_cols]
+            frame_std = np.max(frames.std(axis=(1, 2)), axis=-1)
+            min_std = min(min_std, np.min(frame_std))
+
+    return float(min_std)
+
+
 def train_classifier(vectors, labels):
     clf = SVC(gamma=settings.train_gamma, C=settings.train_c)
     start_time = timer()
@@ -245,6 +281,26 @@ if __name__ == '__main__':
     print('SCORE OF NOT FLOOR TEST SET: {}'.format(not_floor_score))
     print('==================================================')
 
+    # Frames whose filter responses vary less than this are classified as
+    # floor by the detector without running the classifier
+    min_boundary_std = find_min_feature_std(
+        filtered_floor_images,
+        filtered_not_floor_images,
+        min(rospy.get_param('~min_floor_patches'),
+            rospy.get_param('~min_anti_floor_patches')))
+    settings.min_feature_std = MIN_FEATURE_STD_MARGIN * min_boundary_std
+
+    single_class_std = np.max(np.append(filtered_floor_images,
+                                        filtered_not_floor_images,
+                                        axis=0).std(axis=(1, 2)), axis=-1)
+    print('==============FILTER RESPONSE SPREAD==============')
+    print('Smallest spread in a boundary frame: {}'.format(min_boundary_std))
+    print('Minimum feature std: {}'.format(settings.min_feature_std))
+    print('Training frames skipping the classifier: {} of {}'.format(
+        np.count_nonzero(single_class_std < settings.min_feature_std),
+        single_class_std.shape[0]))
+    print('==================================================')
+
     # Find the latest revision of the settings
 
     postfix = rospy.get_param('~classifier_settings_postfix')
@@ -273,3 +329,4 @@ if __name__ == '__main__':
 
     settings.clf = clf
     pickle.dump(settings, open(saved_filepath, 'wb'))
+    save_classifier(settings, os.path.splitext(saved_filepath)[0] + '.npz')
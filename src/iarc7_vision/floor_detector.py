@@ -2,12 +2,14 @@
 from timeit import default_timer as timer
 import pickle
 import glob
+import os
 import tf2_geometry_msgs
 from tf2_geometry_msgs import Vector3Stamped, PointStamped
 from geometry_msgs.msg import Point
 import math
 from tf import transformations
 from collections import deque
+import threading
 
 import rospy
 import rospkg
@@ -18,10 +20,18 @@ from cv_bridge import CvBridge, CvBridgeError
 import tensorflow as tf
 from sklearn.svm import SVC
 
+try:
+    from numba import njit
+except ImportError:
+    # The geometry helpers run as plain python without numba
+    njit = None
+
 from sensor_msgs.msg import Image
 
 from iarc7_vision.filterbank import get_RFS_filters_in_tensorflow_format
 from iarc7_vision.image_filter_applicator import ImageFilterApplicator
+from iarc7_vision.rbf_classifier import RBFClassifier
+from iarc7_vision.image_utils import imgmsg_to_array
 
 from visualization_msgs.msg import Marker
 
@@ -29,6 +39,21 @@ from iarc7_msgs.msg import Boundary
 
 bridge = CvBridge()
 
+# Scatter matrices worse conditioned than this fall back to an SVM when
+# finding the boundary line
+MAX_BOUNDARY_SCATTER_CONDITION = 1e8
+
+# Results of find_viewport_intersection
+INTERSECTION_FOUND = 1
+NO_INTERSECTION = 0
+INTERSECTION_ERROR = -1
+
+# Factor the debug image is downsampled by before publishing
+DEBUG_DOWNSAMPLE = 2
+
+# Number of rendered debug image texts kept for reuse
+MAX_CACHED_DEBUG_TEXTS = 64
+
 
 class DebugData(object):
     def __init__(self):
@@ -39,17 +64,97 @@ class DebugData(object):
         self.center_point = None
         self.failed_arena_edge = False
 
-def image_callback(data):
-    debug_data = DebugData()
-    detection = find_boundary_line(data, debug_data)
-
-    if detection is None:
-        detection = [0, 0, 0, 0, 0, data.header.stamp]
-
-    filter_detections(detection)
+class PreparedImage(object):
+    def __init__(self):
+        self.trans = None
+        self.cropped_shape = None
+        self.focal_length = None
+        self.resize_fractions = None
+        self.resized_image = None
 
-    if publish_visualization:
-        publish_debug(debug_data, data.header.stamp)
+def image_callback(data):
+    with pending_images_condition:
+        # While a batch is being processed the detector is behind the
+        # camera, so only the newest image is kept for the next one
+        if processing_batch:
+            pending_images.clear()
+        pending_images.append(data)
+        pending_images_condition.notify()
+
+def process_images():
+    global processing_batch
+
+    while not rospy.is_shutdown():
+        with pending_images_condition:
+            processing_batch = False
+            while len(pending_images) == 0:
+                pending_images_condition.wait(0.1)
+                if rospy.is_shutdown():
+                    return
+
+            # When batching, give the images after the first one up to the
+            # batch timeout to arrive
+            batch_deadline = timer() + filter_batch_timeout
+            while len(pending_images) < filter_batch_size:
+                remaining = batch_deadline - timer()
+                if remaining <= 0:
+                    break
+                pending_images_condition.wait(remaining)
+
+            batch = list(pending_images)
+            pending_images.clear()
+            processing_batch = True
+
+        # Keep the thread alive through errors in a single batch
+        try:
+            process_batch(batch)
+        except Exception as e:
+            rospy.logerr('Floor detection failed: {}'.format(e))
+
+def process_batch(batch):
+    global last_debug_stamp
+
+    prepared_images = []
+    num_resized = 0
+    for data in batch:
+        debug_data = DebugData()
+        prepared = prepare_image(data, debug_data, resized_buffer[num_resized])
+        if prepared is not None:
+            num_resized += 1
+        prepared_images.append((data, prepared, debug_data))
+
+    if num_resized > 0:
+        if profile:
+            start_time = timer()
+
+        np.multiply(resized_buffer[:num_resized], np.float32(1 / 255.0),
+                    out=filter_input_buffer[:num_resized])
+        results = filter_applicator.apply_filters(
+            filter_input_buffer[:num_resized], show_result=False)
+
+        if profile:
+            end_time = timer()
+            rospy.logdebug('Filtered {} images in {} seconds fps: {}'.format(
+                num_resized, end_time - start_time,
+                num_resized / (end_time - start_time)))
+
+    result_index = 0
+    for data, prepared, debug_data in prepared_images:
+        detection = None
+        if prepared is not None:
+            detection = find_boundary_line(
+                data, prepared, results[result_index], debug_data)
+            result_index += 1
+
+        if detection is None:
+            detection = [0, 0, 0, 0, 0, data.header.stamp]
+
+        filter_detections(detection)
+
+        if publish_visualization \
+                and data.header.stamp - last_debug_stamp >= min_debug_period:
+            last_debug_stamp = data.header.stamp
+            publish_debug(debug_data, data.header.stamp)
 
 def filter_detections(detection):
     global detections
@@ -137,9 +242,9 @@ def validate_detection(detection):
 
     return np.average(distances)
 
-def find_boundary_line(data, debug_data):
+def prepare_image(data, debug_data, resized_image):
     try:
-        image = bridge.imgmsg_to_cv2(data, "rgb8")
+        image = imgmsg_to_array(data, "rgb8")
     except CvBridgeError as e:
         rospy.logerr(e)
 
@@ -159,68 +264,88 @@ def find_boundary_line(data, debug_data):
     if height < settings.min_height:
         return
 
-    start_time = timer()
+    # The crop only depends on the image size and the height, so it's
+    # computed once per centimeter of height
+    key = (image.shape[0], image.shape[1], int(height * 100))
+    crop = crop_cache.get(key)
+    if crop is None:
+        crop = crop_cache[key] = compute_crop(image.shape, key[2] / 100.0)
+    crop_amount_height, crop_amount_width, focal_length, resize_fractions = crop
 
-    crop_amount_width = int(image.shape[1] - min(image.shape[1] / (
-        height / settings.min_height), image.shape[1])) / 2
-    crop_amount_height = int(image.shape[0] - min(image.shape[0] / (
-        height / settings.min_height), image.shape[0])) / 2
     cropped = image[crop_amount_height:image.shape[0] - crop_amount_height,
                     crop_amount_width:image.shape[1] - crop_amount_width]
 
-    focal_length = math.sqrt(image.shape[1]**2 + image.shape[0]**2) / (2 * math.tan(afov / 2))
-    new_afov = 2 * math.atan(math.sqrt(cropped.shape[1]**2 + cropped.shape[0]**2) / focal_length)
-    resize_fractions = np.asarray((float(settings.target_size[0]) / cropped.shape[1], float(settings.target_size[1]) / cropped.shape[0]))
+    prepared = PreparedImage()
+    prepared.trans = trans
+    prepared.cropped_shape = cropped.shape
+    prepared.focal_length = focal_length
+    prepared.resize_fractions = resize_fractions
 
-    resized_image = cv2.resize(
-        cropped, settings.target_size, interpolation=cv2.INTER_LINEAR)
+    cv2.resize(cropped, settings.target_size, dst=resized_image,
+               interpolation=cv2.INTER_LINEAR)
+    prepared.resized_image = resized_image
     debug_data.resized_image = resized_image
+    return prepared
 
-    result = filter_applicator.apply_filters(
-        np.asarray([np.float32(resized_image) / 255.0]), show_result=False)
+def compute_crop(image_shape, height):
+    """
+    Find how much to crop from each side of an image taken at height so
+    that it covers the same floor area as one taken at min_height
 
-    end_time = timer()
-    rospy.logdebug('Filtered 1 image in {} seconds fps: {}'.format(
-        end_time - start_time, 1 / (end_time - start_time)))
+    :return: rows and columns to crop from each side, focal length in
+             pixels, and the scale factors from the cropped image to
+             target_size
+    """
+    crop_amount_width = int(image_shape[1] - min(image_shape[1] / (
+        height / settings.min_height), image_shape[1])) // 2
+    crop_amount_height = int(image_shape[0] - min(image_shape[0] / (
+        height / settings.min_height), image_shape[0])) // 2
 
-    shape = result.shape
-    vectors = []
-    for j in range(0, shape[1]):
-        for k in range(0, shape[2]):
-            vectors.append(result[0, j, k, :])
+    cropped_width = image_shape[1] - 2 * crop_amount_width
+    cropped_height = image_shape[0] - 2 * crop_amount_height
 
-    vectors = np.asarray(vectors)
+    focal_length = math.sqrt(image_shape[1]**2 + image_shape[0]**2) \
+                   / (2 * math.tan(afov / 2))
+    resize_fractions = np.asarray(
+        (float(settings.target_size[0]) / cropped_width,
+         float(settings.target_size[1]) / cropped_height))
+    resize_fractions.flags.writeable = False
 
-    prediction = settings.clf.predict(vectors)
+    return crop_amount_height, crop_amount_width, focal_length, resize_fractions
 
-    prediction = np.reshape(prediction, (shape[1], shape[2]))
-    debug_data.prediction = prediction
 
-    # Convert prediction values to positions with the labels
-    # based on the known location of the avaraging squares
-    block_height = (settings.average_size - 1) * settings.stride + 1
-    block_width = block_height
+def find_boundary_line(data, prepared, result, debug_data):
+    trans = prepared.trans
+    focal_length = prepared.focal_length
+    resize_fractions = prepared.resize_fractions
+    resized_image = prepared.resized_image
 
-    # Points are centered in prediction boxes
-    points = []
-    labels = []
-    for i in range(0, prediction.shape[0]):
-        for j in range(0, prediction.shape[1]):
-            new_point = ((block_height / 2) + (i * block_height) +
-                         (settings.kernel_size / 2) +
-                         (i * (settings.kernel_size / 2)), (block_width / 2) +
-                         (j * block_width) + (settings.kernel_size / 2) +
-                         (j * (settings.kernel_size / 2)))
-            points.append(new_point)
-            labels.append(prediction[i, j])
-    points = np.asarray(points)
+    shape = result.shape
+    # Each patch's feature vector is already contiguous in the filter
+    # output, so flatten the spatial dimensions instead of copying
+    vectors = np.ascontiguousarray(result).reshape(-1, shape[-1])
+
+    # Filter responses that vary less across the patches than in any frame
+    # with a boundary during training mean there is no boundary to find, so
+    # skip the floor classifier and treat the frame as floor
+    if settings.min_feature_std is not None \
+            and np.max(result.std(axis=(0, 1))) < settings.min_feature_std:
+        prediction = np.zeros((shape[0], shape[1]))
+    else:
+        prediction = settings.floor_clf.predict(vectors)
+        prediction = np.reshape(prediction, (shape[0], shape[1]))
+    debug_data.prediction = prediction
+
+    points = patch_centers
     debug_data.points = points
 
-    labels = np.asarray(labels)
+    labels = prediction.ravel()
+    anti_floor_labels = labels == 1
+    anti_floor_count = np.count_nonzero(anti_floor_labels)
 
     # Make sure all the detections aren't of one class
     # before trying to find the boundary line
-    if np.sum(labels) > 0 and np.sum(labels) < len(labels):
+    if anti_floor_count > 0 and anti_floor_count < len(labels):
         # Train an SVM on the spot to find the boundary line
         line_clf = train_boundary_classifier(points, labels)
     else:
@@ -230,35 +355,42 @@ def find_boundary_line(data, debug_data):
     if line_clf is None:
         return
 
-    # Get a list of points that are on the antifloor side of the line
-    point_classifications = line_clf.predict(points)
-
-    if point_classifications.size - np.sum(point_classifications) < min_floor_patches:
+    # Get a list of points that are on the antifloor side of the line,
+    # coef_ is in the same (row, column) order as the points
+    anti_floor_side = np.dot(points, line_clf.coef_[0]) \
+                      + line_clf.intercept_[0] > 0
+
+    # Patch counts on each side of the line, from the two masks and their
+    # overlap instead of a pass per check
+    anti_floor_side_count = np.count_nonzero(anti_floor_side)
+    floor_side_count = anti_floor_side.size - anti_floor_side_count
+    anti_floor_side_anti_floor = np.logical_and(anti_floor_side,
+                                                anti_floor_labels)
+    anti_floor_side_anti_floor_count = np.count_nonzero(
+        anti_floor_side_anti_floor)
+    floor_side_floor_count = floor_side_count - (
+        anti_floor_count - anti_floor_side_anti_floor_count)
+
+    if floor_side_count < min_floor_patches:
         debug_data.failed_arena_edge = True
         return
 
-    floor_side_floor = (np.ones(point_classifications.shape) - point_classifications) * (np.ones(point_classifications.shape) - labels)
-
-    ratio = np.sum(floor_side_floor) / (point_classifications.shape[0] - np.sum(point_classifications))
+    ratio = float(floor_side_floor_count) / floor_side_count
     if ratio < min_floor_appearance_ratio:
         debug_data.failed_arena_edge = True
         return
 
-    if np.sum(point_classifications) < min_anti_floor_patches:
+    if anti_floor_side_count < min_anti_floor_patches:
         debug_data.failed_arena_edge = True
         return
 
-    anti_floor_side_anti_floor = point_classifications * labels
-
-    ratio = np.sum(anti_floor_side_anti_floor) / np.sum(point_classifications)
+    ratio = float(anti_floor_side_anti_floor_count) / anti_floor_side_count
     if ratio < min_anti_floor_appearance_ratio:
         debug_data.failed_arena_edge = True
         return
 
-    edge_mask = np.pad(np.zeros((shape[1]-2, shape[2]-2)), 1, 'constant', constant_values = 1).flatten()
-
-    anti_floor_side_anti_floor_edge = edge_mask * anti_floor_side_anti_floor
-    if np.sum(anti_floor_side_anti_floor_edge) < min_anti_floor_on_edge:
+    if np.count_nonzero(anti_floor_side_anti_floor[edge_mask]) \
+            < min_anti_floor_on_edge:
         debug_data.failed_arena_edge = True
         return
 
@@ -269,62 +401,20 @@ def find_boundary_line(data, debug_data):
     d = line_clf.intercept_[0]
     #rospy.logerr('d: {}'.format(d))
 
-    # Test for the equation of the line that will be used
-    # (1) y = -(c1/c2)x - (d/c2) if abs(c1) < abs(img_height * c2)
-    # (2) x = -(d/c1) if abs(c1) >= abs(img_height * c2) (assumes that c2/c1 ~= 0)
-
-    # If using equation (1)
-    if abs(c1) < abs(c2 * resized_image.shape[0]):
-        # Test all four sides to find the intersection points
-        #rospy.logerr('c1: {} c2: {}'.format(c1, c2))
-        points = []
-        a = -(c1/c2)
-        b = -(d/c2)
-
-        # Test intersection with top of viewport
-        top_intersect = -(b/a)
-        #rospy.logerr('b: {} a: {}'.format(b, a))
-        #rospy.logerr('top_intersect {}'.format(top_intersect))
-        if top_intersect >= 0 and top_intersect <= resized_image.shape[1]:
-            points.append((top_intersect, 0.0))
-
-        # Test intersection with bottom of viewport
-        bottom_intersect = (resized_image.shape[0] - b) / a
-        #rospy.logerr('bottom_intersect {}'.format(bottom_intersect))
-        if bottom_intersect >= 0 and bottom_intersect <= resized_image.shape[1]:
-            points.append((bottom_intersect, float(resized_image.shape[0])))
+    p1x, p1y, p2x, p2y, status = find_viewport_intersection(
+        c1, c2, d, resized_image.shape[0], resized_image.shape[1])
 
-        # Test intersection left side of viewport
-        left_intersect = b
-        #rospy.logerr('left_intersect {}'.format(left_intersect))
-        if left_intersect >= 0 and left_intersect <= resized_image.shape[0]:
-            points.append((0.0, left_intersect))
-
-        # Test intersection with right side of viewport
-        right_intersect = a * resized_image.shape[1] + b
-        #rospy.logerr('right_intersect {}'.format(right_intersect))
-        if right_intersect >= 0 and right_intersect <= resized_image.shape[0]:
-            points.append((float(resized_image.shape[1]), right_intersect))
-
-        # If there are 0 points then the line didn't intersect with the viewport
-        if len(points) == 0:
-            return
-
-        # If there are not two points at this point there was an error
-        if len(points) != 2:
-            rospy.logerr('Floor detector error calculating intersection points with equation 1')
-            return
+    # If there are 0 points then the line didn't intersect with the viewport
+    if status == NO_INTERSECTION:
+        return
 
-        p1 = points[0]
-        p2 = points[1]
+    # If there are not two points at this point there was an error
+    if status == INTERSECTION_ERROR:
+        rospy.logerr('Floor detector error calculating intersection points with equation 1')
+        return
 
-    # If using equation (2)
-    else:
-        x_intercept = -d/c1
-        if x_intercept < 0 or x_intercept > resized_image.shape[1]:
-            return
-        p1 = (x_intercept, 0.0)
-        p2 = (x_intercept -(c2/c1)*resized_image.shape[0], float(resized_image.shape[0]))
+    p1 = (p1x, p1y)
+    p2 = (p2x, p2y)
 
     center_point = (p2[0] + (p1[0] - p2[0])/2.0, p2[1] + (p1[1] - p2[1])/2.0)
     debug_data.center_point = center_point
@@ -387,7 +477,7 @@ def find_boundary_line(data, debug_data):
     # Get the position of the wall using the camera transform stuff
     undistorted_pix_pos = center_point / resize_fractions
     # Get the ray
-    pix_ray = [undistorted_pix_pos[0] - cropped.shape[1] / 2, undistorted_pix_pos[1] - cropped.shape[0] / 2, focal_length]
+    pix_ray = [undistorted_pix_pos[0] - prepared.cropped_shape[1] / 2, undistorted_pix_pos[1] - prepared.cropped_shape[0] / 2, focal_length]
     unit_pix_ray = pix_ray / np.linalg.norm(pix_ray)
 
     camera_ray = Vector3Stamped()
@@ -432,7 +522,7 @@ def find_boundary_line(data, debug_data):
     else:
         rospy.logerr('FLOOR DETECTOR CAN NOT USE CAMERA ROTATION')
 
-    line_side = line_clf.decision_function((test_point_coordinate, ))
+    line_side = np.dot(test_point_coordinate, line_clf.coef_[0]) + line_clf.intercept_[0]
 
     marker = Marker()
     marker.header.frame_id = 'level_quad'
@@ -507,111 +597,320 @@ def publish_debug(data, stamp):
     if resized_image is None or points is None or prediction is None:
         return
 
-    block_height = (settings.average_size - 1) * settings.stride + 1
-    block_width = block_height
-
-    resized_image = resized_image / 2
-    for i in range(0, prediction.shape[0]):
-        for j in range(0, prediction.shape[1]):
-            if prediction[i, j] == 0:
-                resized_image[
-                    (i * block_height) + (settings.kernel_size / 2) +
-                    (i * (settings.kernel_size / 2)):(i * block_height) +
-                    (settings.kernel_size / 2) +
-                    (i * (settings.kernel_size / 2)) + block_height,
-                    (j * block_width) + (settings.kernel_size / 2) +
-                    (j * (settings.kernel_size / 2)):(j * block_width) +
-                    (settings.kernel_size / 2) +
-                    (j * (settings.kernel_size / 2)) + block_width, 1] = 200
-            elif prediction[i, j] == 1:
-                resized_image[
-                    (i * block_height) + (settings.kernel_size / 2) +
-                    (i * (settings.kernel_size / 2)):(i * block_height) +
-                    (settings.kernel_size / 2) +
-                    (i * (settings.kernel_size / 2)) + block_height,
-                    (j * block_width) + (settings.kernel_size / 2) +
-                    (j * (settings.kernel_size / 2)):(j * block_width) +
-                    (settings.kernel_size / 2) +
-                    (j * (settings.kernel_size / 2)) + block_width, 0] = 200
-    for p in points:
-        resized_image[int(p[0]), int(p[1]), :] = 0
+    # The debug image is published at a lower resolution than the
+    # detector works at
+    resized_image = resized_image[::DEBUG_DOWNSAMPLE, ::DEBUG_DOWNSAMPLE] // 2
+    pixel_prediction = prediction[pixel_patch_rows, pixel_patch_cols]
+    resized_image[..., 1][patch_pixel_mask & (pixel_prediction == 0)] = 200
+    resized_image[..., 0][patch_pixel_mask & (pixel_prediction == 1)] = 200
+    resized_image[points[:, 0] // DEBUG_DOWNSAMPLE,
+                  points[:, 1] // DEBUG_DOWNSAMPLE, :] = 0
 
     # Try to draw the line classifiers line, sometimes impossible due to
     # precision problems
-    try:
-        if line_clf is not None:
-            coefficients = line_clf.coef_
-            # Use the coefficients to characterize the line
-            # Check for cases where floating point precision will cause all kinds of
-            # weird miscalculations
-            c1 = line_clf.coef_[0, 1]
-            c2 = line_clf.coef_[0, 0]
-            d = line_clf.intercept_[0]
-            # Is the line a well defined vertical line?
-            if abs(c1) < abs(c2 * resized_image.shape[0]):
-                p1 = (0, -d / c2)
-                p2 = (resized_image.shape[1],
-                      (-d / c2) - (resized_image.shape[1] * c1 / c2))
-                p1 = (int(p1[0]), int(p1[1]))
-                p2 = (int(p2[0]), int(p2[1]))
-                cv2.line(resized_image, p1, p2, (0, 0, 255))
-            else:
-                # Find the x intercept
-                x_int = int(-d / c1)
-                if x_int >= 0 and x_int <= resized_image.shape[1]:
-                    cv2.line(resized_image,
-                             (x_int, 0),
-                             (x_int, resized_image.shape[0]),
-                             (0, 0, 255))
-    except ZeroDivisionError as e:
-        rospy.logerr('Caught ZeroDivisionError in floor detector')
-        return
+    if line_clf is not None:
+        c1 = line_clf.coef_[0, 1]
+        c2 = line_clf.coef_[0, 0]
+        d = line_clf.intercept_[0]
+        p1x, p1y, p2x, p2y, drawable = find_debug_line(
+            c1, c2, d, data.resized_image.shape[0], data.resized_image.shape[1])
+        if drawable:
+            cv2.line(resized_image,
+                     (p1x // DEBUG_DOWNSAMPLE, p1y // DEBUG_DOWNSAMPLE),
+                     (p2x // DEBUG_DOWNSAMPLE, p2y // DEBUG_DOWNSAMPLE),
+                     (0, 0, 255))
 
     if data.failed_arena_edge:
-        cv2.putText(resized_image, 'No edge', (2, 15), cv2.FONT_HERSHEY_PLAIN, 1, (255,255,255))
+        draw_debug_text(resized_image, 'No edge', (1, 8))
 
     if center_point is not None:
-        resized_image[int(center_point[1]), int(center_point[0]), 0] = 255
-        cv2.putText(resized_image, 'c: {0:.2f} {0:.2f}'.format(center_point[0], center_point[1]), (2, 30), cv2.FONT_HERSHEY_PLAIN, 1, (255,255,255))
+        resized_image[int(center_point[1]) // DEBUG_DOWNSAMPLE,
+                      int(center_point[0]) // DEBUG_DOWNSAMPLE, 0] = 255
+        # Rounded to the pixel so the text repeats while the center point
+        # stays still
+        draw_debug_text(resized_image,
+                        'c: {0:d} {1:d}'.format(int(round(center_point[0])),
+                                                int(round(center_point[1]))),
+                        (1, 16))
 
     debug_msg = bridge.cv2_to_imgmsg(resized_image, encoding="rgb8")
     debug_msg.header.stamp = stamp
     debug_visualization_pub.publish(debug_msg)
 
 
-def train_boundary_classifier(vectors, labels):
-    clf = SVC(kernel="linear", C=0.025)
-    start_time = timer()
-    clf.fit(vectors, labels)
-    end_time = timer()
-    rospy.logdebug(
-        'Trained on {} vectors in {} seconds vectors/sec: {}'.format(
-            vectors.shape[0], end_time - start_time,
-            vectors.shape[0] / (end_time - start_time)))
+def draw_debug_text(image, text, origin):
+    """
+    Draw white text on the debug image, reusing the pixels rendered the
+    last time the same text was drawn at the same place
+    """
+    key = (text, origin, image.shape)
+    rendered = debug_text_cache.get(key)
+    if rendered is None:
+        if len(debug_text_cache) >= MAX_CACHED_DEBUG_TEXTS:
+            debug_text_cache.clear()
+        canvas = np.zeros(image.shape[:2], dtype=np.uint8)
+        cv2.putText(canvas, text, origin, cv2.FONT_HERSHEY_PLAIN, 0.5, 255)
+        pixels = np.nonzero(canvas)
+        # Coverage of each pixel, in case the text is antialiased
+        alpha = np.float32(canvas[pixels] / 255.0)[:, np.newaxis]
+        rendered = debug_text_cache[key] = (pixels, alpha)
+
+    pixels, alpha = rendered
+    background = np.float32(image[pixels])
+    image[pixels] = np.rint(background + (255 - background) * alpha)
+
+
+class LinearBoundary(object):
+    """
+    Linear decision boundary with the same coef_ and intercept_ attributes
+    as a linear SVC
+    """
+    def __init__(self, coef, intercept):
+        self.coef_ = coef
+        self.intercept_ = intercept
+
+
+def train_boundary_classifier(points, labels):
+    if profile:
+        start_time = timer()
+
+    # Fisher linear discriminant gives the direction of the boundary
+    points = np.asarray(points, dtype=np.float64)
+    floor_points = points[labels == 0]
+    anti_floor_points = points[labels == 1]
+    floor_mean = floor_points.mean(axis=0)
+    anti_floor_mean = anti_floor_points.mean(axis=0)
+    floor_diff = floor_points - floor_mean
+    anti_floor_diff = anti_floor_points - anti_floor_mean
+    scatter = (np.dot(floor_diff.T, floor_diff)
+               + np.dot(anti_floor_diff.T, anti_floor_diff)) \
+              / max(points.shape[0] - 2, 1)
+
+    # The pooled scatter is singular when the patches of both classes only
+    # spread along the same direction (e.g. each class filling whole rows of
+    # a two row grid), the Fisher direction is undefined there so let the
+    # SVM handle those
+    if np.linalg.cond(scatter) > MAX_BOUNDARY_SCATTER_CONDITION:
+        clf = SVC(kernel="linear", C=boundary_svm_c)
+        clf.fit(points, labels)
+    else:
+        coef = np.linalg.solve(scatter, anti_floor_mean - floor_mean)
+
+        # Place the boundary between the projected patches where it
+        # misclassifies the fewest of them, the midpoint between the class
+        # means is biased towards the smaller class
+        projections = np.dot(points, coef)
+        order = np.argsort(projections)
+        sorted_projections = projections[order]
+        sorted_labels = labels[order] == 1
+        anti_floor_below = np.concatenate(([0], np.cumsum(sorted_labels)))
+        floor_below = np.arange(points.shape[0] + 1) - anti_floor_below
+        errors = anti_floor_below + (floor_below[-1] - floor_below)
+        split = np.argmin(errors)
+        if split == 0:
+            threshold = sorted_projections[0] - 1.0
+        elif split == points.shape[0]:
+            threshold = sorted_projections[-1] + 1.0
+        else:
+            threshold = 0.5 * (sorted_projections[split - 1]
+                               + sorted_projections[split])
+
+        clf = LinearBoundary(coef[np.newaxis, :], np.asarray((-threshold, )))
+
+    if profile:
+        end_time = timer()
+        rospy.logdebug(
+            'Trained on {} vectors in {} seconds vectors/sec: {}'.format(
+                points.shape[0], end_time - start_time,
+                points.shape[0] / (end_time - start_time)))
     return clf
 
 
+def find_viewport_intersection(c1, c2, d, height, width):
+    """
+    Find the two points where the line c1*x + c2*y + d = 0 crosses the
+    edges of a width x height viewport.
+
+    Returns (p1x, p1y, p2x, p2y, status), status is INTERSECTION_FOUND if
+    the points are valid, NO_INTERSECTION if the line misses the viewport
+    and INTERSECTION_ERROR if the wrong number of crossings was found.
+    """
+    # Test for the equation of the line that will be used
+    # (1) y = -(c1/c2)x - (d/c2) if abs(c1) < abs(img_height * c2)
+    # (2) x = -(d/c1) if abs(c1) >= abs(img_height * c2) (assumes that c2/c1 ~= 0)
+
+    # If using equation (1)
+    if abs(c1) < abs(c2 * height):
+        # Test all four sides to find the intersection points
+        xs = np.zeros(4)
+        ys = np.zeros(4)
+        num_points = 0
+        a = -(c1/c2)
+        b = -(d/c2)
+
+        # Test intersection with top of viewport
+        top_intersect = -(b/a)
+        if top_intersect >= 0 and top_intersect <= width:
+            xs[num_points] = top_intersect
+            ys[num_points] = 0.0
+            num_points += 1
+
+        # Test intersection with bottom of viewport
+        bottom_intersect = (height - b) / a
+        if bottom_intersect >= 0 and bottom_intersect <= width:
+            xs[num_points] = bottom_intersect
+            ys[num_points] = float(height)
+            num_points += 1
+
+        # Test intersection left side of viewport
+        left_intersect = b
+        if left_intersect >= 0 and left_intersect <= height:
+            xs[num_points] = 0.0
+            ys[num_points] = left_intersect
+            num_points += 1
+
+        # Test intersection with right side of viewport
+        right_intersect = a * width + b
+        if right_intersect >= 0 and right_intersect <= height:
+            xs[num_points] = float(width)
+            ys[num_points] = right_intersect
+            num_points += 1
+
+        if num_points == 0:
+            return 0.0, 0.0, 0.0, 0.0, NO_INTERSECTION
+
+        if num_points != 2:
+            return 0.0, 0.0, 0.0, 0.0, INTERSECTION_ERROR
+
+        return xs[0], ys[0], xs[1], ys[1], INTERSECTION_FOUND
+
+    # If using equation (2)
+    x_intercept = -d/c1
+    if x_intercept < 0 or x_intercept > width:
+        return 0.0, 0.0, 0.0, 0.0, NO_INTERSECTION
+    return (x_intercept, 0.0,
+            x_intercept - (c2/c1)*height, float(height),
+            INTERSECTION_FOUND)
+
+
+def find_debug_line(c1, c2, d, height, width):
+    """
+    Find the pixel endpoints of the line c1*x + c2*y + d = 0 to draw on a
+    width x height debug image.
+
+    Returns (p1x, p1y, p2x, p2y, drawable), the endpoints are clipped to
+    the image and drawable is False when the line misses the image or its
+    endpoints aren't finite.
+    """
+    # Is the line a well defined vertical line?
+    if abs(c1) < abs(c2 * height):
+        y1 = -d / c2
+        y2 = (-d / c2) - (width * c1 / c2)
+        if not (np.isfinite(y1) and np.isfinite(y2)):
+            return 0, 0, 0, 0, False
+        if min(y1, y2) > height or max(y1, y2) < 0:
+            return 0, 0, 0, 0, False
+
+        # Move endpoints off the image onto its edge along the line, huge
+        # endpoints don't fit in an int
+        x1 = 0.0
+        x2 = float(width)
+        if min(y1, y2) < 0 or max(y1, y2) > height:
+            slope = width / (y2 - y1)
+            clipped_y1 = min(max(y1, 0.0), float(height))
+            clipped_y2 = min(max(y2, 0.0), float(height))
+            x1 = (clipped_y1 - y1) * slope
+            x2 = (clipped_y2 - y1) * slope
+            y1 = clipped_y1
+            y2 = clipped_y2
+        return int(x1), int(y1), int(x2), int(y2), True
+
+    # Find the x intercept
+    x_intercept = -d / c1
+    if not (x_intercept >= 0 and x_intercept <= width):
+        return 0, 0, 0, 0, False
+    x_int = int(x_intercept)
+    return x_int, 0, x_int, height, True
+
+
+if njit is not None:
+    # Division by zero gives inf like it does on numpy scalars instead of
+    # raising
+    find_viewport_intersection = njit(cache=True, error_model='numpy')(
+        find_viewport_intersection)
+    find_debug_line = njit(cache=True, error_model='numpy')(find_debug_line)
+
+
+def pixel_patch_indices(num_pixels, num_patches, block_size, gap):
+    """
+    Find the index of the prediction patch covering each pixel along one
+    axis of the resized image, patches are block_size pixels wide and
+    separated by gap pixels. Pixels not covered by a patch get -1.
+    """
+    pixels = np.arange(num_pixels) - gap
+    indices = pixels // (block_size + gap)
+    indices[(pixels < 0)
+            | (pixels % (block_size + gap) >= block_size)
+            | (indices >= num_patches)] = -1
+    return indices
+
+
 def load_classifier():
     rospack = rospkg.RosPack()
 
     postfix = rospy.get_param('~classifier_settings_postfix')
     revision = rospy.get_param('~revision_name')
 
+    prefix = rospack.get_path('iarc7_vision') \
+             + '/classifiers/floor_classifier_params_r'
+
     if revision == 'latest':
-        classifiers = sorted(glob.glob(rospack.get_path('iarc7_vision') \
-                                       + '/classifiers/floor_classifier_params_r*_' \
-                                       + postfix \
-                                       + '.clf'))
-        filename = classifiers[-1]
+        classifiers = sorted(
+            os.path.splitext(filename)[0]
+            for extension in ('.clf', '.npz')
+            for filename in glob.glob(prefix + '*_' + postfix + extension))
+        basename = classifiers[-1]
     else:
-        filename = rospack.get_path('iarc7_vision') \
-                   + '/classifiers/floor_classifier_params_r' \
-                   + str(revision) \
-                   + '.clf'
+        basename = prefix + str(revision)
+
+    # Prefer the numpy archive, the pickle is kept for classifiers that
+    # haven't been converted
+    if os.path.exists(basename + '.npz'):
+        filename = basename + '.npz'
+        rospy.loginfo('Floor detector settings file: {}'.format(filename))
+
+        floor_clf, metadata = RBFClassifier.load(filename)
+        settings = SettingsObject()
+        for name, value in metadata.items():
+            setattr(settings, str(name), value)
+        settings.target_size = tuple(settings.target_size)
+    else:
+        filename = basename + '.clf'
+        rospy.loginfo('Floor detector settings file: {}'.format(filename))
 
-    rospy.loginfo('Floor detector settings file: {}'.format(filename))
-    clf = pickle.load(open(filename, "rb"))
-    return clf
+        settings = pickle.load(open(filename, "rb"))
+        floor_clf = RBFClassifier.from_svc(settings.clf)
+
+    # Classifiers trained before the filter response threshold was added
+    # always run the floor classifier
+    if not hasattr(settings, 'min_feature_std'):
+        settings.min_feature_std = None
+
+    settings.floor_clf = floor_clf
+    return settings
+
+
+def save_classifier(settings, filename, dtype=np.float64):
+    """
+    Save the classifier in settings.clf and the rest of the settings as a
+    numpy archive readable by load_classifier
+
+    The classifier is scored in dtype when loaded, see
+    RBFClassifier.from_svc before saving one as float32
+    """
+    metadata = dict((name, value) for name, value in vars(settings).items()
+                    if name not in ('clf', 'floor_clf'))
+    RBFClassifier.from_svc(settings.clf, dtype=dtype).save(filename, metadata)
 
 
 class SettingsObject(object):
@@ -629,9 +928,11 @@ if __name__ == '__main__':
     min_anti_floor_patches = rospy.get_param('~min_anti_floor_patches')
     min_anti_floor_appearance_ratio = rospy.get_param('~min_anti_floor_appearance_ratio')
     min_anti_floor_on_edge = rospy.get_param('~min_anti_floor_on_edge')
+    boundary_svm_c = rospy.get_param('~boundary_svm_c')
 
     camera_rotation = rospy.get_param('~camera_rotation')
     afov = rospy.get_param('~afov')
+    crop_cache = {}
 
     detections = deque()
     min_boundary_detections = rospy.get_param('~min_boundary_detections')
@@ -652,10 +953,56 @@ if __name__ == '__main__':
         settings.n_orientations,
         show_filters=False)
 
+    use_tensorflow_filters = rospy.get_param('~use_tensorflow_filters')
     filter_applicator = ImageFilterApplicator(
-        filters, settings.target_size, settings.stride, settings.average_size)
+        filters, settings.target_size, settings.stride, settings.average_size,
+        use_tensorflow=use_tensorflow_filters)
+
+    # Compile the geometry helpers now instead of in the first callback
+    find_viewport_intersection(1.0, 1.0, 0.0, 1, 1)
+    find_debug_line(1.0, 1.0, 0.0, 1, 1)
+
+    # The layout of the prediction patches only depends on the classifier
+    # settings, so run the filters once to find the prediction size and
+    # compute everything derived from it here
+    prediction_shape = filter_applicator.apply_filters(
+        np.zeros((1, settings.target_size[1], settings.target_size[0], 3),
+                 dtype=np.float32)).shape[1:3]
+
+    # Patches are spaced out by the averaging squares plus half a kernel
+    block_height = (settings.average_size - 1) * settings.stride + 1
+    block_width = block_height
+    half_kernel = settings.kernel_size // 2
+    patch_row_starts = np.arange(prediction_shape[0]) * (block_height + half_kernel) + half_kernel
+    patch_col_starts = np.arange(prediction_shape[1]) * (block_width + half_kernel) + half_kernel
+
+    # Points are centered in prediction boxes
+    patch_centers = np.stack(np.meshgrid(patch_row_starts + block_height // 2,
+                                         patch_col_starts + block_width // 2,
+                                         indexing='ij'),
+                             axis=-1).reshape(-1, 2)
+
+    # Patch covering each pixel of the downsampled debug image, used to
+    # paint the predictions onto it
+    pixel_patch_rows = pixel_patch_indices(
+        settings.target_size[1], prediction_shape[0], block_height, half_kernel)[::DEBUG_DOWNSAMPLE]
+    pixel_patch_cols = pixel_patch_indices(
+        settings.target_size[0], prediction_shape[1], block_width, half_kernel)[::DEBUG_DOWNSAMPLE]
+    patch_pixel_mask = np.logical_and.outer(pixel_patch_rows >= 0,
+                                            pixel_patch_cols >= 0)
+    pixel_patch_rows = np.maximum(pixel_patch_rows, 0)[:, np.newaxis]
+    pixel_patch_cols = np.maximum(pixel_patch_cols, 0)[np.newaxis, :]
+
+    edge_mask = np.pad(np.zeros((prediction_shape[0] - 2, prediction_shape[1] - 2), dtype=bool),
+                       1, 'constant', constant_values=True).ravel()
+
+    # Time the filters and boundary line fit, logged at debug level
+    profile = rospy.get_param('~profile')
 
     publish_visualization = rospy.get_param('~publish_visualization')
+    min_debug_period = rospy.Duration(1.0 / rospy.get_param('~max_debug_rate'))
+    last_debug_stamp = rospy.Time(0)
+    debug_text_cache = {}
 
     if publish_visualization:
         debug_visualization_pub = rospy.Publisher(
@@ -667,7 +1014,36 @@ if __name__ == '__main__':
 
     detection_publisher = rospy.Publisher('/floor_detector/boundaries', Boundary, queue_size=10)
 
+    # Only tensorflow gets faster by filtering several images at once, the
+    # numpy filters always take one image at a time
+    if use_tensorflow_filters:
+        filter_batch_size = rospy.get_param('~filter_batch_size')
+        filter_batch_timeout = rospy.get_param('~filter_batch_timeout')
+    else:
+        filter_batch_size = 1
+        filter_batch_timeout = 0.0
+    # Images waiting for the processing thread, at most one batch of them
+    pending_images = deque(maxlen=filter_batch_size)
+    pending_images_condition = threading.Condition()
+    processing_batch = False
+
+    # Resized images and the scaled filter inputs for a batch are written
+    # into these instead of allocating new arrays for every image
+    resized_buffer = np.empty((filter_batch_size,
+                               settings.target_size[1],
+                               settings.target_size[0],
+                               3), dtype=np.uint8)
+    filter_input_buffer = np.empty(resized_buffer.shape, dtype=np.float32)
+
+    processing_thread = threading.Thread(target=process_images)
+    processing_thread.daemon = True
+    processing_thread.start()
+
+    # The receive buffer has to fit a whole image, with the default size
+    # rospy can hand over images that have been waiting in the socket
+    # instead of the latest one
     image_topic = rospy.get_param('~camera_topic')
-    rospy.Subscriber(image_topic, Image, image_callback, queue_size=1)
+    rospy.Subscriber(image_topic, Image, image_callback, queue_size=1,
+                     buff_size=2**24, tcp_nodelay=True)
 
     rospy.spin()
@@ -3,11 +3,15 @@
 import rospy
 import cv2
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import matplotlib.pyplot as plt
 import tensorflow as tf
 
 from opencv_display_mult_floor import im_show_m
 
+# Same weights as tf.image.rgb_to_grayscale
+RGB_TO_GRAY_WEIGHTS = np.asarray((0.2989, 0.5870, 0.1140), dtype=np.float32)
+
 def stretch_contrast(img):
     maximum = np.max(img)
     minimum = np.min(img)
@@ -15,18 +19,27 @@ def stretch_contrast(img):
     return (img-minimum)*(1.0/(maximum-minimum))
 
 class ImageFilterApplicator:
-    def __init__(self, filterbank, incoming_resolution, stride, average_size):
+    def __init__(self, filterbank, incoming_resolution, stride, average_size,
+                 use_tensorflow=False):
         self.filterbank = filterbank
         self.incoming_resolution = incoming_resolution
         self.average_size = average_size
         self.stride = stride
+        self.use_tensorflow = use_tensorflow
 
-        self._construct_tensor_graph()
+        if self.use_tensorflow:
+            self._construct_tensor_graph()
+        else:
+            # Every filter is applied with one matrix product over the
+            # image patches the strided convolution visits
+            kernel_size = self.filterbank.shape[0]
+            self.filter_matrix = np.float32(self.filterbank.reshape(
+                kernel_size * kernel_size, self.filterbank.shape[3]))
 
     def _construct_tensor_graph(self, output_graph=False):
         self.placeholder_image = tf.placeholder(tf.float32,
                                                 shape=(
-                                                  1,
+                                                  None,
                                                   self.incoming_resolution[1],
                                                   self.incoming_resolution[0],
                                                   3))
@@ -67,11 +80,55 @@ class ImageFilterApplicator:
         config.gpu_options.allow_growth = True
         self.sess = tf.Session(config=config)
 
+    def _apply_filters_numpy(self, image):
+        """
+        Same operations as the tensorflow graph: grayscale, valid strided
+        convolution with the filterbank, square, average pool, and an
+        average pool of the colors
+        """
+        gray = np.ascontiguousarray(np.dot(image, RGB_TO_GRAY_WEIGHTS))
+        batch, height, width = gray.shape
+        kernel_size = self.filterbank.shape[0]
+        conv_height = (height - kernel_size) // self.stride + 1
+        conv_width = (width - kernel_size) // self.stride + 1
+
+        # View of every kernel sized patch visited by the convolution
+        patches = as_strided(gray,
+                             shape=(batch, conv_height, conv_width,
+                                    kernel_size, kernel_size),
+                             strides=(gray.strides[0],
+                                      self.stride * gray.strides[1],
+                                      self.stride * gray.strides[2],
+                                      gray.strides[1],
+                                      gray.strides[2]))
+        convolved = np.dot(
+            patches.reshape(-1, kernel_size * kernel_size),
+            self.filter_matrix).reshape(batch, conv_height, conv_width, -1)
+
+        squared = np.square(convolved)
+
+        size = self.average_size
+        averaged = squared[:, :conv_height // size * size,
+                           :conv_width // size * size].reshape(
+                               batch, conv_height // size, size,
+                               conv_width // size, size, -1).mean(axis=(2, 4))
+
+        size = 3 * self.average_size
+        average_rgb = image[:, :height // size * size,
+                            :width // size * size].reshape(
+                                batch, height // size, size,
+                                width // size, size, 3).mean(axis=(2, 4))
+
+        return [averaged, average_rgb]
+
     def apply_filters(self, image, show_result=False):
 
-        result = self.sess.run([self.averaged,
-                                self.average_rgb],
-                                feed_dict={self.placeholder_image: image})
+        if self.use_tensorflow:
+            result = self.sess.run([self.averaged,
+                                    self.average_rgb],
+                                    feed_dict={self.placeholder_image: image})
+        else:
+            result = self._apply_filters_numpy(image)
         #result = np.asarray(result)
         #result = result.flatten(axis=0)
         #print result[0].shape
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+import numpy as np
+from cv_bridge import CvBridge
+
+bridge = CvBridge()
+
+# Encodings that can be viewed directly as height x width x 3 uint8 arrays
+THREE_CHANNEL_8BIT_ENCODINGS = ('rgb8', 'bgr8')
+
+
+def imgmsg_to_array(msg, encoding):
+    """
+    Get the pixels of an image message as a numpy array in the requested
+    encoding
+
+    :param msg: image to convert
+    :type msg: sensor_msgs.msg.Image
+    :param encoding: desired encoding, e.g. "rgb8" or "bgr8"
+    :return: height x width x channels image
+    :rtype: numpy.ndarray
+
+    .. note::
+        When the message is already in the requested three channel 8 bit
+        encoding the array is a read only view of msg.data, not a copy, and
+        is only valid as long as msg is. Other encodings are converted (and
+        copied) by cv_bridge, which raises CvBridgeError on failure.
+    """
+    if msg.encoding != encoding \
+            or encoding not in THREE_CHANNEL_8BIT_ENCODINGS:
+        return bridge.imgmsg_to_cv2(msg, encoding)
+
+    return np.ndarray(shape=(msg.height, msg.width, 3),
+                      dtype=np.uint8,
+                      buffer=msg.data,
+                      strides=(msg.step, 3, 1))
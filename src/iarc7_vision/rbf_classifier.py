@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import json
+
+import numpy as np
+from scipy.linalg.blas import get_blas_funcs
+
+
+class RBFClassifier(object):
+    """
+    Prediction half of a trained two class RBF kernel SVM. Kernel values
+    are computed from squared distances expanded into a matrix product
+    with the support vectors, which keeps the work in BLAS instead of
+    going through LIBSVM one vector at a time.
+    """
+    def __init__(self,
+                 support_vectors,
+                 dual_coef,
+                 intercept,
+                 gamma,
+                 classes,
+                 batch_size=2048):
+        self.support_vectors = support_vectors
+        self.dual_coef = dual_coef
+        self.intercept = intercept
+        self.gamma = gamma
+        self.classes = classes
+
+        # Number of vectors scored at once, bounds the size of the kernel
+        # matrix so it stays in cache
+        self.batch_size = batch_size
+
+        self.support_vectors_squared = np.sum(np.square(support_vectors),
+                                              axis=1)
+
+        # The kernel matrix product goes straight to BLAS gemm (sgemm for
+        # float32) instead of through np.dot. BLAS is column major, so the
+        # product is computed as sv . batch^T into a Fortran ordered buffer,
+        # whose transpose is the C ordered batch x sv kernel matrix. The
+        # buffer is reused between calls, so one instance must not be used
+        # from several threads at once.
+        self._support_vectors_fortran = np.asfortranarray(support_vectors)
+        self._gemm = get_blas_funcs('gemm', (self._support_vectors_fortran,))
+        self._kernel_buffer = np.empty(
+            (support_vectors.shape[0], batch_size),
+            dtype=support_vectors.dtype,
+            order='F')
+
+    @classmethod
+    def from_svc(cls, clf, dtype=np.float64, batch_size=2048):
+        """
+        Extract the support vectors and coefficients of a fitted
+        sklearn.svm.SVC with an RBF kernel
+
+        Scoring is done in dtype. float64 gives the same labels as LIBSVM.
+        float32 matches the filter outputs and halves the memory traffic of
+        the kernel matrix, but the rounding grows with the dual
+        coefficients and flips labels close to the boundary, so only use it
+        for classifiers it has been checked against.
+        """
+        if clf.kernel != 'rbf' or len(clf.classes_) != 2:
+            raise ValueError('Only two class RBF kernel SVMs are supported')
+
+        return cls(np.asarray(clf.support_vectors_, dtype=dtype),
+                   np.asarray(clf.dual_coef_[0], dtype=dtype),
+                   float(clf.intercept_[0]),
+                   float(clf._gamma),
+                   clf.classes_,
+                   batch_size=batch_size)
+
+    @classmethod
+    def load(cls, filename, batch_size=2048):
+        """
+        Load a classifier saved with save
+
+        :return: the classifier and the metadata dictionary saved with it
+        """
+        with np.load(filename) as archive:
+            clf = cls(archive['support_vectors'],
+                      archive['dual_coef'],
+                      float(archive['intercept']),
+                      float(archive['gamma']),
+                      archive['classes'],
+                      batch_size=batch_size)
+            metadata = json.loads(str(archive['metadata']))
+        return clf, metadata
+
+    def save(self, filename, metadata):
+        """
+        Save the classifier as a numpy archive, which loads without
+        unpickling sklearn and LIBSVM objects
+
+        :param metadata: JSON serializable dictionary stored alongside
+        """
+        np.savez(filename,
+                 support_vectors=self.support_vectors,
+                 dual_coef=self.dual_coef,
+                 intercept=self.intercept,
+                 gamma=self.gamma,
+                 classes=self.classes,
+                 metadata=json.dumps(metadata))
+
+    def decision_function(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=self.support_vectors.dtype)
+        scores = np.empty(vectors.shape[0], dtype=self.support_vectors.dtype)
+
+        for start in range(0, vectors.shape[0], self.batch_size):
+            batch = vectors[start:start + self.batch_size]
+
+            # |v - sv|^2 = |v|^2 + |sv|^2 - 2 v.sv
+            kernel = self._gemm(-2.0,
+                                self._support_vectors_fortran,
+                                batch.T,
+                                c=self._kernel_buffer[:, :batch.shape[0]],
+                                overwrite_c=1).T
+            kernel += np.sum(np.square(batch), axis=1)[:, np.newaxis]
+            kernel += self.support_vectors_squared
+            # Rounding can leave tiny negative distances
+            np.maximum(kernel, 0.0, out=kernel)
+
+            kernel *= -self.gamma
+            np.exp(kernel, out=kernel)
+
+            scores[start:start + batch.shape[0]] = \
+                np.dot(kernel, self.dual_coef) + self.intercept
+
+        return scores
+
+    def predict(self, vectors):
+        return self.classes[np.int8(self.decision_function(vectors) > 0)]
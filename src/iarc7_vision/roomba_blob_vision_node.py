@@ -7,8 +7,8 @@ side camera node.
 
 Algorithm:
 
-    1. Perform HSV color filtering to select only the relevant red and green
-       pixels.
+    1. Downsample the image and perform HSV color filtering to select only
+       the relevant red and green pixels.
     2. Use median filtering to remove stray pixels while retaining the edge
        details on the red and green pixel clumps.
     3. Find contours on the remaining pixel clumps.
@@ -30,10 +30,11 @@ Example:
     $ rosrun iarc7_vision roomba_blob_vision_node.py left_camera right_camera
 
 .. note::
-    Contrary to online code, the do_transform_vector3 method DOES NOT create a
-    deep copy of the transform first, and thus this method will set the
-    translation of the transform to the origin! This can be seen in the file:
-    `python2.7/dist-packages/tf2_geometry_msgs/tf2_geometry_msgs.py`
+    Camera rays are rotated into the map frame with rotate_vector instead of
+    tf2_geometry_msgs.do_transform_vector3. Contrary to online code, that
+    method DOES NOT create a deep copy of the transform first, and thus sets
+    the translation of the transform to the origin! This can be seen in the
+    file: `python2.7/dist-packages/tf2_geometry_msgs/tf2_geometry_msgs.py`
 
 .. note:
     The default behavior is to act as a camera cv node with debugging
@@ -44,68 +45,211 @@ Example:
 from __future__ import print_function
 import rospy
 import cv2
-from cv_bridge import CvBridge, CvBridgeError
+from cv_bridge import CvBridgeError
 
-from geometry_msgs.msg import Point, TransformStamped, Vector3Stamped, PointStamped
+from geometry_msgs.msg import Point, Pose, PoseWithCovariance, Quaternion, \
+                              TransformStamped, Vector3
+from std_msgs.msg import ColorRGBA, Header
 from sensor_msgs.msg import Image, CameraInfo
 from visualization_msgs.msg import Marker
 from iarc7_msgs.msg import OdometryArray
 from nav_msgs.msg import Odometry
 
 import tf2_ros
-import tf2_geometry_msgs
 import image_geometry
 
+from iarc7_vision.image_utils import imgmsg_to_array
+
 import numpy as np
 import math
-import copy
 from sys import argv
 import threading
 
+try:
+    from numba import njit, prange, types
+except ImportError:
+    # filter_ranges falls back to OpenCV without numba
+    njit = None
+
 NODE_NAME = "roomba_blob_vision_node"
 # From: iarc7_simulator/sim/src/sim/builder/robots/Roomba.py
 ROOMBA_HEIGHT = 0.065
 
-def pixel_to_ray(image_coords, image_shape, daov):
+# Fixed point precision of OpenCV's 8 bit BGR to HSV conversion
+HSV_SHIFT = 12
+
+def hsv_division_tables():
+    """
+    Build the reciprocal tables OpenCV uses to convert 8 bit BGR to HSV
+    without dividing, so the conversion here gives the same values
+
+    :return: saturation and hue (for the 0-180 range) tables, indexed by
+             value and by max - min respectively
+    """
+    divisors = np.arange(256, dtype=np.float64)
+    divisors[0] = np.inf
+    saturation = np.int32(np.rint((255 << HSV_SHIFT) / divisors))
+    hue = np.int32(np.rint((180 << HSV_SHIFT) / (6.0 * divisors)))
+    return saturation, hue
+
+SATURATION_DIVISION, HUE_DIVISION = hsv_division_tables()
+
+def filter_hsv_ranges(frame, lows, highs, mask):
+    """
+    Mark the pixels of a BGR frame whose HSV values are inside any of the
+    ranges with 255 in mask and the rest with 0, converting to HSV on the
+    fly instead of going through a full HSV image and a mask per range
+
+    :param frame: 3-channel BGR image
+    :param lows: lower HSV bound of each range, inclusive
+    :param highs: upper HSV bound of each range, inclusive
+    :param mask: single channel output image with the rows and columns of
+                 frame
     """
-    Convert 2D pixel coordinates to 3D ray
+    round_half = 1 << (HSV_SHIFT - 1)
+    for row in prange(frame.shape[0]):
+        for col in range(frame.shape[1]):
+            b = np.int32(frame[row, col, 0])
+            g = np.int32(frame[row, col, 1])
+            r = np.int32(frame[row, col, 2])
+
+            # Same integer arithmetic as cv2.cvtColor(frame, COLOR_BGR2HSV)
+            v = max(b, g, r)
+            diff = v - min(b, g, r)
+            s = (diff * SATURATION_DIVISION[v] + round_half) >> HSV_SHIFT
+            if v == r:
+                h = g - b
+            elif v == g:
+                h = b - r + 2 * diff
+            else:
+                h = r - g + 4 * diff
+            h = (h * HUE_DIVISION[diff] + round_half) >> HSV_SHIFT
+            if h < 0:
+                h += 180
+
+            keep = False
+            for i in range(lows.shape[0]):
+                if lows[i, 0] <= h <= highs[i, 0] \
+                        and lows[i, 1] <= s <= highs[i, 1] \
+                        and lows[i, 2] <= v <= highs[i, 2]:
+                    keep = True
+                    break
+
+            mask[row, col] = 255 if keep else 0
+
+if njit is not None:
+    # Compiled at import so the first frame doesn't wait on the JIT, for
+    # both writable frames and read only views of image messages. The GIL
+    # is released like OpenCV does, so rospy's threads can run meanwhile.
+    filter_hsv_ranges = njit(
+        [types.void(frame_type,
+                    types.uint8[:, ::1],
+                    types.uint8[:, ::1],
+                    types.uint8[:, ::1])
+         for frame_type in (types.uint8[:, :, ::1],
+                            types.Array(types.uint8, 3, 'C', readonly=True))],
+        parallel=True, nogil=True, cache=True)(filter_hsv_ranges)
+
+def camera_intrinsics(image_shape, daov):
+    """
+    Find the constants pixels_to_ground needs for a camera
 
-    :param image_coords: (x,y) coordinates of the pixel
     :param image_shape: numpy.shape in the form (rows, cols, channels)
     :param daov: Diagonal angle of view in degrees
-    :return: direction from image pixels
+    :return: focal length in pixels and the (x,y) coordinates of the image
+             center
     """
     rows = 1.*image_shape[0]
     cols = 1.*image_shape[1]
-    pix_x = 1.*image_coords[0] - cols * 0.5
-    pix_y = 1.*image_coords[1] - rows * 0.5
 
-    pix_r = math.sqrt( pix_x*pix_x + pix_y*pix_y )
     PR = math.sqrt( rows*rows + cols*cols ) * 0.5
 
     max_phi = math.radians(daov * 0.5)
     pix_focal = PR / math.tan(max_phi)
-    theta = math.atan2(pix_y, pix_x)
+    return pix_focal, cols * 0.5, rows * 0.5
 
-    camera_focal = -1
-    camera_radius = camera_focal * pix_r / pix_focal
+def rotate_vector(q, v):
+    """
+    Rotate a vector by a unit quaternion, without the translation
+    tf2_geometry_msgs would apply to a point
 
-    direction = Vector3Stamped()
-    direction.vector.x = camera_radius * math.cos( theta )
-    direction.vector.y = camera_radius * math.sin( theta )
-    direction.vector.z = camera_focal
-    return direction
+    :param q: (x, y, z, w) quaternion
+    :param v: (x, y, z) vector
+    :return: (x, y, z) rotated vector
+    """
+    qx, qy, qz, qw = q
+    vx, vy, vz = v
+    # v' = v + w t + q x t, where t = 2 q x v
+    tx = 2 * (qy * vz - qz * vy)
+    ty = 2 * (qz * vx - qx * vz)
+    tz = 2 * (qx * vy - qy * vx)
+    return (vx + qw * tx + qy * tz - qz * ty,
+            vy + qw * ty + qz * tx - qx * tz,
+            vz + qw * tz + qx * ty - qy * tx)
+
+def pixels_to_ground(image_coords, pix_focal, center_x, center_y, q, cam_pos,
+                     height):
+    """
+    Find where the rays through pixels of a camera image hit a horizontal
+    plane in the map frame
+
+    :param image_coords: (x,y) coordinates of the pixels
+    :type image_coords: numpy.ndarray of shape N x 2 with dtype float64
+    :param pix_focal: focal length in pixels, from camera_intrinsics
+    :param center_x: x coordinate of the image center
+    :param center_y: y coordinate of the image center
+    :param q: (x, y, z, w) rotation from the camera frame to the map frame
+    :param cam_pos: (x, y, z) position of the camera in the map frame
+    :param height: height of the plane
+    :return: (x, y) map frame coordinates of each pixel on the plane
+    :rtype: numpy.ndarray of shape N x 2
+    """
+    ground = np.empty((image_coords.shape[0], 2))
+    camera_focal = -1.0
+    for i in range(image_coords.shape[0]):
+        # Convert the pixel to a camera ray. Scaling the pixel's distance
+        # from the center by camera_focal / pix_focal along its angle is the
+        # same as scaling each offset
+        cam_ray = ((image_coords[i, 0] - center_x) * (camera_focal / pix_focal),
+                   (image_coords[i, 1] - center_y) * (camera_focal / pix_focal),
+                   camera_focal)
+
+        # Convert that camera ray to world space (map frame)
+        # See note in script header about do_transform_vector3
+        map_ray = rotate_vector(q, cam_ray)
+
+        # Scale the direction to hit the plane
+        # Direction scale should always be positive
+        direction_scale = - (cam_pos[2] - height) / map_ray[2]
+        ground[i, 0] = cam_pos[0] + map_ray[0] * direction_scale
+        ground[i, 1] = cam_pos[1] + map_ray[1] * direction_scale
+    return ground
+
+if njit is not None:
+    rotate_vector = njit(nogil=True, cache=True)(rotate_vector)
+    # Compiled at import so the first detection doesn't wait on the JIT
+    pixels_to_ground = njit(
+        'float64[:, ::1](float64[:, ::1], float64, float64, float64, '
+        'UniTuple(float64, 4), UniTuple(float64, 3), float64)',
+        nogil=True, cache=True)(pixels_to_ground)
 
 class Debugger(object):
     
     def __init__(self, image_on=True, rviz_on=True):
         self._image_enabled = image_on
         self._rviz_enabled = rviz_on
+        self._grid_key = None
+        self._grid = None
+        self._small_grid = None
         if self._rviz_enabled:
             self.rviz_pub = rospy.Publisher('visualization_marker', Marker, \
                                                   queue_size=10)
             self.rviz_frame = "map"
             self.rviz_namespace = NODE_NAME
+
+    @property
+    def image_enabled(self):
+        return self._image_enabled
         
     def image_grid(self, title, *args):
         """
@@ -121,21 +265,25 @@ class Debugger(object):
         if not self._image_enabled or len(args)==0:
             return
         f1 = args[0]
-        black = np.zeros(f1.shape, dtype=f1.dtype)
-        f2 = black if len(args) < 2 else args[1]
-        row1 = np.hstack((f1, f2))
-        if len(args) < 3:
-            row1 = cv2.resize(row1,None,fx=0.5,fy=0.5,
-                              interpolation=cv2.INTER_CUBIC)
-            cv2.imshow(title, row1)
-        else:
-            f3 = black if len(args) < 3 else args[2]
-            f4 = black if len(args) < 4 else args[3]
-            row2 = np.hstack((f3, f4))
-            columns = np.vstack((row1,row2))
-            columns = cv2.resize(columns,None,fx=0.5,fy=0.5, 
-                              interpolation=cv2.INTER_CUBIC)
-            cv2.imshow(title, columns)
+        rows, cols = f1.shape[:2]
+        grid_rows = 1 if len(args) < 3 else 2
+
+        # Reuse the grid between frames, missing images stay black
+        grid_key = (f1.shape, f1.dtype, len(args))
+        if self._grid_key != grid_key:
+            self._grid_key = grid_key
+            self._grid = np.zeros((grid_rows * rows, 2 * cols) + f1.shape[2:],
+                                  dtype=f1.dtype)
+            self._small_grid = None
+
+        for i, image in enumerate(args[:4]):
+            row, col = divmod(i, 2)
+            self._grid[row*rows:(row+1)*rows, col*cols:(col+1)*cols] = image
+
+        self._small_grid = cv2.resize(self._grid, None, dst=self._small_grid,
+                                      fx=0.5, fy=0.5,
+                                      interpolation=cv2.INTER_AREA)
+        cv2.imshow(title, self._small_grid)
         cv2.waitKey(1)
 
     def rviz_lines(self, points, line_id):
@@ -148,61 +296,75 @@ class Debugger(object):
         """
         if not self._rviz_enabled:
             return
-        line = Marker()
-        line.header.frame_id = self.rviz_frame
-        line.header.stamp = rospy.Time.now()
-        line.ns = self.rviz_namespace
-        line.action = Marker.ADD
-        line.id = line_id
-        line.type = Marker.LINE_LIST
-
-        line.pose.orientation.w = 1.0
-        line.scale.x = 0.03
-        line.color.r = 1.0
-        line.color.a = 1.0
-
-        line.points = points
+        line = Marker(header=Header(frame_id=self.rviz_frame,
+                                    stamp=rospy.Time.now()),
+                      ns=self.rviz_namespace,
+                      action=Marker.ADD,
+                      id=line_id,
+                      type=Marker.LINE_LIST,
+                      pose=Pose(orientation=Quaternion(w=1.0)),
+                      scale=Vector3(x=0.03),
+                      color=ColorRGBA(r=1.0, a=1.0),
+                      points=points)
 
         self.rviz_pub.publish(line)
 
 class ImageRoombaFinder(object):
+
+    # Number of times the frame is halved with cv2.pyrDown before searching
+    # it, the blobs of interest are at least 10 pixels across so they
+    # survive a few halvings
+    pyramid_levels = 1
+    # Median filter size on the downsampled mask, 3 pixels at half
+    # resolution covers about the same area as 5 at full resolution
+    median_size = 3
+    # Smallest bounding box side kept, in full resolution pixels
+    min_roomba_size = 10
     
     def __init__(self):
         self.debug = Debugger(False, False)
 
     def filter_ranges(self, frame, ranges):
         """
-        Filter the image to only areas between the HSV values described in
+        Find the areas of the image between the HSV values described in
         ranges. This will not alter the original image.
     
         :param frame: 3-channel image to apply HSV range filters to
         :type frame: numpy.ndarray
         :param ranges: list of disjointed HSV ranges
         :type ranges: list of 3-element tuples
-        :return: 3-channel filtered image
+        :return: single channel mask, 255 inside the ranges and 0 elsewhere
         :rtype: numpy.ndarray
     
         .. note::
             In OpenCV, the HSV ranges are [0,180], [0,255], [0,255].
         """
+        if njit is not None:
+            frame = np.ascontiguousarray(frame)
+            mask = np.empty(frame.shape[:2], dtype=np.uint8)
+            filter_hsv_ranges(frame,
+                              np.ascontiguousarray(ranges[:, 0], dtype=np.uint8),
+                              np.ascontiguousarray(ranges[:, 1], dtype=np.uint8),
+                              mask)
+            return mask
+
         hsv_image = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-        # Create black image the same size as frame
-        out = np.zeros(frame.shape, dtype=frame.dtype)
-        for r in ranges:
-            # Create mask
-            mask = cv2.inRange(hsv_image, r[0], r[1])
-            # Apply the mask
-            out = cv2.add(out, cv2.bitwise_and(frame, frame, mask=mask))
-        return out
+        mask = cv2.inRange(hsv_image, ranges[0][0], ranges[0][1])
+        range_mask = np.empty_like(mask)
+        for r in ranges[1:]:
+            # Add the pixels in this range to the mask, in place
+            cv2.inRange(hsv_image, r[0], r[1], dst=range_mask)
+            cv2.bitwise_or(mask, range_mask, dst=mask)
+        return mask
 
     def filter_roombas(self, frame):
         """
-        Keep only the roombas in the frame
+        Find the pixels of the roombas in the frame
         
         :param frame: raw BGR image in which to find roombas
         :type frame: numpy.ndarray of shape 3 x WIDTH x HEIGHT with dtype uint8
-        :return: filtered frame
-        :rtype: numpy.ndarray of shape 3 x WIDTH x HEIGHT with dtype uint8
+        :return: mask of the roomba pixels, 255 on roombas and 0 elsewhere
+        :rtype: numpy.ndarray of shape WIDTH x HEIGHT with dtype uint8
     
         .. note::
             From a few sample images, it seems that the saturation can go as
@@ -227,43 +389,68 @@ class ImageRoombaFinder(object):
             # [[165, 80,100], [179,255,255]], # High Red
         ])
         # frame = cv2.GaussianBlur(frame,(5,5),0)
-        filtered_frame = self.filter_ranges(frame, ranges)
-        filtered_frame = cv2.medianBlur(filtered_frame, 5)
-        return filtered_frame
+        mask = self.filter_ranges(frame, ranges)
+        # The median of a 0/255 mask is 255 where most of the window is
+        # 255, so it's computed as a thresholded box filter, which unlike
+        # cv2.medianBlur doesn't slow down with the window size. Edges are
+        # replicated like medianBlur does.
+        mask = cv2.boxFilter(mask, -1, (self.median_size, self.median_size),
+                             borderType=cv2.BORDER_REPLICATE)
+        cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY, dst=mask)
+        return mask
 
     def bound_roombas(self, frame):
         """
         Find bounding boxes for all pixel clumps (roombas) with dimensions
         larger than 10 pixels on each side. Also draws the bounding rects onto
-        the original frame.
+        a copy of the frame for the debug image. The search runs on the frame
+        downsampled pyramid_levels times, the boxes are in original frame
+        coordinates.
     
-        :param img_gray: single channel image used to find edges
-        :type img_gray: numpy.ndarray of shape 1 x WIDTH x HEIGHT & dtype uint8
-        :param img: original three channel (BGR) image to draw boxes on
-        :type img: numpy.ndarray of shape 3 x WIDTH x HEIGHT and dtype uint8
-        :return: Iterator object containing (x, y) pairs
+        :param frame: original three channel (BGR) image, not modified
+        :type frame: numpy.ndarray of shape 3 x WIDTH x HEIGHT and dtype uint8
+        :return: center of each box
+        :rtype: numpy.ndarray of (x, y) rows
         """
-        # remove everything from the original image that is not a roomba
-        roombas = self.filter_roombas(frame)
-        # convert original image to single channel
-        frame_gray = cv2.cvtColor(roombas, cv2.COLOR_BGR2GRAY)
-        # find the contours in this single channel image
+        # search a downsampled frame, every step after this is
+        # proportional to the number of pixels
+        small_frame = frame
+        for _ in range(self.pyramid_levels):
+            small_frame = cv2.pyrDown(small_frame)
+        scale = 2 ** self.pyramid_levels
+
+        # find everything in the original image that is a roomba
+        mask = self.filter_roombas(small_frame)
+        # remove everything from the original image that is not a roomba,
+        # only needed to show it. findContours can modify the mask, so this
+        # is done first.
+        if self.debug.image_enabled:
+            # frame can be a read only view of an image message
+            frame = frame.copy()
+            roombas = cv2.bitwise_and(small_frame, small_frame, mask=mask)
+            roombas = cv2.resize(roombas, (frame.shape[1], frame.shape[0]),
+                                 interpolation=cv2.INTER_NEAREST)
+        # find the contours in the mask
         # RETR_EXTERNAL won't match boxes inside other boxes
-        results = cv2.findContours(frame_gray, cv2.RETR_EXTERNAL,
+        results = cv2.findContours(mask, cv2.RETR_EXTERNAL,
                                    cv2.CHAIN_APPROX_SIMPLE)
         if cv2.__version__[0] == 3:
             results.pop(0)
         contours, _ = results
+        centers = []
         for c in contours:
-            rect = cv2.boundingRect(c)
+            # scale the rect back to the original frame
+            x, y, w, h = (scale * v for v in cv2.boundingRect(c))
             # Skip tiny boxes
             # TODO change minimum size based on drone position
-            if rect[2] < 10 or rect[3] < 10: continue
-            x, y, w, h = rect # unpack the rect
-            cv2.rectangle(frame, (x,y), (x+w,y+h), (0,255,0), 4)
-            yield (x + w/2, y + h/2)
-        # After the generator is done, debug the image
-        self.debug.image_grid(self.base_topic, frame, roombas)
+            if w < self.min_roomba_size or h < self.min_roomba_size: continue
+            if self.debug.image_enabled:
+                cv2.rectangle(frame, (x,y), (x+w,y+h), (0,255,0), 4)
+            centers.append((x + w/2, y + h/2))
+        # After all the boxes are drawn, debug the image
+        if self.debug.image_enabled:
+            self.debug.image_grid(self.base_topic, frame, roombas)
+        return np.array(centers, dtype=np.float64).reshape(-1, 2)
 
 class CameraProcessor(ImageRoombaFinder):
 
@@ -274,10 +461,18 @@ class CameraProcessor(ImageRoombaFinder):
 
         self.odom_array = OdometryArray()
         self.odom_lock = threading.Lock()
-
-        self.bridge = CvBridge()
+        # (x, y) of each roomba in odom_array, in the same order. Detections
+        # are matched against this instead of the messages, which are only
+        # written to publish.
+        self._positions = np.empty((0, 2), dtype=np.float64)
+        # Storage _positions is a view of, with room to append roombas
+        self._position_buffer = self._positions
 
         self.daov = rospy.get_param("~roomba_estimator_settings/%s_aov"%base_topic)
+        # camera_intrinsics for the last image shape seen, the shape is
+        # only known once images arrive
+        self.intrinsics_shape = None
+        self.intrinsics = None
 
         self.tf_buffer = tf2_ros.Buffer()
         tf2_ros.TransformListener(self.tf_buffer)
@@ -285,16 +480,70 @@ class CameraProcessor(ImageRoombaFinder):
         self.tf_buffer.lookup_transform('map', 'bottom_camera_rgb_optical_frame',
                                         rospy.Time(0), rospy.Duration(3.0))
 
-        rospy.Subscriber("/{}/rgb/image_raw".format(base_topic), Image, self.callback)
+        # Only the newest image is kept for processing, older ones are
+        # dropped if processing falls behind the camera
+        self._latest_image = None
+        self._latest_image_lock = threading.Lock()
+        self._image_ready = threading.Event()
+
+        rospy.Subscriber("/{}/rgb/image_raw".format(base_topic), Image,
+                         self.callback, queue_size=1, buff_size=2**24,
+                         tcp_nodelay=True)
         rospy.Subscriber("/roombas", OdometryArray, self.roombas_callback)
         self.publisher = rospy.Publisher("/roombas", OdometryArray,
                                          queue_size=10)
 
+    def start(self):
+        """
+        Start processing this camera's images on a thread of its own, so
+        cameras don't wait on each other or on rospy's callback threads
+        """
+        worker = threading.Thread(target=self.process_images,
+                                  name=self.base_topic)
+        worker.daemon = True
+        worker.start()
         
     def callback(self, data):
         """
-        Receive the callback from the camera, process the image, and publish
-        the roomba locations found
+        Receive the callback from the camera and hand the image to the
+        processing thread, replacing any image it hasn't started on yet
+
+        :param data: Image
+        :type data: sensor_msgs.msg.Image
+        :return: None
+        """
+        self._latest_image_lock.acquire()
+        self._latest_image = data
+        self._latest_image_lock.release()
+        self._image_ready.set()
+
+    def process_images(self):
+        """
+        Process the newest image from the camera whenever there is one
+        """
+        while not rospy.is_shutdown():
+            self._image_ready.wait()
+            self._image_ready.clear()
+
+            self._latest_image_lock.acquire()
+            data = self._latest_image
+            self._latest_image = None
+            self._latest_image_lock.release()
+
+            if data is None:
+                continue
+
+            # Keep the thread alive through errors in a single frame
+            try:
+                self.process_image(data)
+            except Exception as e:
+                rospy.logerr('Roomba detection on {} failed: {}'.format(
+                    self.base_topic, e))
+
+    def process_image(self, data):
+        """
+        Process an image from the camera and publish the roomba locations
+        found
 
         :param data: Image
         :type data: sensor_msgs.msg.Image
@@ -303,7 +552,8 @@ class CameraProcessor(ImageRoombaFinder):
         try:
             if (rospy.Time.now() - data.header.stamp).to_sec() > 0.2:
                 return # Skip image if too old
-            cv_image = self.bridge.imgmsg_to_cv2(data, "bgr8")
+            # Read only view of the message's pixels, not a copy
+            cv_image = imgmsg_to_array(data, "bgr8")
             # This should get the transform at the time of the image, but that
             # causes errors
             trans = self.tf_buffer.lookup_transform('map',
@@ -314,8 +564,18 @@ class CameraProcessor(ImageRoombaFinder):
             rospy.logerr(e)
 
     def roombas_callback(self, msg):
+        num_roombas = len(msg.data)
+        positions = np.fromiter(
+            (coordinate
+             for item in msg.data
+             for coordinate in (item.pose.pose.position.x,
+                                item.pose.pose.position.y)),
+            dtype=np.float64,
+            count=2 * num_roombas).reshape(num_roombas, 2)
         self.odom_lock.acquire()
         self.odom_array = msg
+        self._positions = positions
+        self._position_buffer = positions
         self.odom_lock.release()
 
 
@@ -333,52 +593,110 @@ class CameraProcessor(ImageRoombaFinder):
     
         .. note::
             The image origin is in the upper-left hand corner
+
+        .. note::
+            Runs on the camera's worker thread, not a rospy callback
+            thread, so rospy receives and deserializes the next image while
+            this one is processed. The OpenCV calls and the numba kernels
+            release the GIL.
         """
         points = []
+        roomba_positions = []
+
+        rotation = trans.transform.rotation
+        q = (rotation.x, rotation.y, rotation.z, rotation.w)
+        # The camera is at the origin of its frame, so its position in the
+        # map frame is the translation of the transform
+        translation = trans.transform.translation
+        cam_pos = (translation.x, translation.y, translation.z)
     
-        for img_coords in self.bound_roombas(frame):
-            cam_ray = pixel_to_ray(img_coords, frame.shape, self.daov)
-            # Convert that camera ray to world space (map frame)
-            # See note in script header about do_transform_vector3
-            map_ray = tf2_geometry_msgs.do_transform_vector3(cam_ray,
-                                                          copy.deepcopy(trans))
-            
-            # Scale the direction to hit the ground (plane z=0)
-            # Direction scale should always be positive
-            cam_pos = tf2_geometry_msgs.do_transform_point(
-                                 PointStamped(point=Point(0,0,0)), trans).point
-            direction_scale = - (cam_pos.z - ROOMBA_HEIGHT) / map_ray.vector.z
-            roomba_pos = Point()
-            roomba_pos.x = cam_pos.x + map_ray.vector.x * direction_scale
-            roomba_pos.y = cam_pos.y + map_ray.vector.y * direction_scale
-            roomba_pos.z = 0
+        if frame.shape[:2] != self.intrinsics_shape:
+            self.intrinsics_shape = frame.shape[:2]
+            self.intrinsics = camera_intrinsics(frame.shape, self.daov)
+
+        pix_focal, center_x, center_y = self.intrinsics
+        # Roombas are found where the rays to their centers hit the plane
+        # of their tops, and placed on the ground (plane z=0)
+        roomba_coords = pixels_to_ground(self.bound_roombas(frame),
+                                         pix_focal, center_x, center_y,
+                                         q, cam_pos, ROOMBA_HEIGHT)
+        for x, y in roomba_coords.tolist():
+            roomba_pos = Point(x=x, y=y, z=0)
     
             # Debug the roomba line
-            points.append(trans.transform.translation)
+            points.append(translation)
             points.append(roomba_pos)
+            roomba_positions.append(roomba_pos)
 
-            # Add the roomba to array and publish
-            self.odom_lock.acquire()
-            sq_tolerance = 0.1 if len(self.odom_array.data) < 10 else 1000
-            for i in xrange(len(self.odom_array.data)):
-                pt = self.odom_array.data[i].pose.pose.position
-                if (roomba_pos.x - pt.x)**2 + \
-                   (roomba_pos.y - pt.y)**2 < sq_tolerance:
-                    self.odom_array.data[i].header.stamp = stamp
-                    self.odom_array.data[i].pose.pose.position = roomba_pos
-                    break
+        if len(roomba_positions) > 0:
+            self.update_roombas(roomba_positions, stamp)
+
+        self.debug.rviz_lines(points, 0)
+
+    def update_roombas(self, roomba_positions, stamp):
+        """
+        Update the closest known roomba to each detection, or add a new
+        roomba when none are close, then publish all of them once
+
+        :param roomba_positions: detected roomba positions in the map frame
+        :type roomba_positions: list of geometry_msgs.msg.Point
+        :param stamp: time the detections were made
+        :return: None
+        """
+        self.odom_lock.acquire()
+        # Match against the position array only, the messages are written
+        # once all the detections are matched
+        num_known = len(self.odom_array.data)
+        detections = {}
+        for roomba_pos in roomba_positions:
+            num_roombas = self._positions.shape[0]
+            sq_tolerance = 0.1 if num_roombas < 10 else 1000
+            # Match the closest known roomba
+            matched = False
+            if num_roombas > 0:
+                sq_distances = np.sum(np.square(
+                    self._positions - (roomba_pos.x, roomba_pos.y)), axis=1)
+                i = int(np.argmin(sq_distances))
+                matched = sq_distances[i] < sq_tolerance
+            if matched:
+                self._positions[i] = (roomba_pos.x, roomba_pos.y)
             else:
-                item = Odometry()
-                item.child_frame_id = "roomba%d"%len(self.odom_array.data)
-                item.header.frame_id = "map"
+                i = num_roombas
+                self._append_position(roomba_pos.x, roomba_pos.y)
+            detections[i] = roomba_pos
+
+        # New roombas have the highest indices, so they are appended in
+        # order
+        for i, roomba_pos in sorted(detections.items()):
+            if i < num_known:
+                item = self.odom_array.data[i]
                 item.header.stamp = stamp
                 item.pose.pose.position = roomba_pos
-                item.pose.pose.orientation.z = 1
-                self.odom_array.data.append(item)
-            self.publisher.publish(self.odom_array)
-            self.odom_lock.release()
-                
-        self.debug.rviz_lines(points, 0)
+            else:
+                self.odom_array.data.append(Odometry(
+                    header=Header(frame_id="map", stamp=stamp),
+                    child_frame_id="roomba%d"%i,
+                    pose=PoseWithCovariance(pose=Pose(
+                        position=roomba_pos,
+                        orientation=Quaternion(z=1)))))
+        self.publisher.publish(self.odom_array)
+        self.odom_lock.release()
+
+    def _append_position(self, x, y):
+        """
+        Add a roomba to the end of _positions, doubling the storage when it
+        is full so appends take amortized constant time
+
+        .. note::
+            Must be called with odom_lock held
+        """
+        num_roombas = self._positions.shape[0]
+        if num_roombas == self._position_buffer.shape[0]:
+            self._position_buffer = np.empty((max(2 * num_roombas, 16), 2),
+                                             dtype=np.float64)
+            self._position_buffer[:num_roombas] = self._positions
+        self._position_buffer[num_roombas] = (x, y)
+        self._positions = self._position_buffer[:num_roombas + 1]
 
 class VideoProcessor(ImageRoombaFinder):
     """
@@ -397,8 +715,7 @@ class VideoProcessor(ImageRoombaFinder):
             retval, frame = cap.read()
             if not retval: # Exit if there is not a frame
                 break
-            for _ in self.bound_roombas(frame):
-                pass
+            self.bound_roombas(frame)
             cv2.waitKey(1)
 
 if __name__ == '__main__':
@@ -415,7 +732,7 @@ if __name__ == '__main__':
     # Change False to True to turn on debugging
     for i in xrange(1, len(argv)):
         if "camera" in argv[i]:
-            CameraProcessor(argv[i], True)
+            CameraProcessor(argv[i], True).start()
 
     # Startup the loop
     try: